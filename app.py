@@ -1,15 +1,133 @@
 from fastapi import FastAPI, UploadFile, HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
 from pydicom.dataset import Dataset, FileDataset
 from pydicom.uid import ExplicitVRLittleEndian, CTImageStorage, generate_uid
+from pydicom.datadict import tag_for_keyword
 from pydicom.errors import InvalidDicomError
-import tempfile, datetime, os, zipfile, io, traceback, pydicom
+from pydicom.filebase import DicomBytesIO
+from pydicom.filewriter import write_dataset, write_file_meta_info
+from pydicom.valuerep import format_number_as_ds
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import asyncio, collections, multiprocessing, tempfile, datetime, functools, os, zipfile, io, shutil, struct, traceback, logging, pydicom
 import nibabel as nib
 import numpy as np
 
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("dicom_fixer")
+
 app = FastAPI(title="DICOM Fixer API")
 
+# Include full tracebacks in per-file error reports (DICOM_FIXER_TRACE=1)
+DEBUG_TRACE = os.environ.get("DICOM_FIXER_TRACE") == "1"
+
+# ZIP members that are treated as DICOM files
+DICOM_EXTENSIONS = frozenset({".dcm", ".raw", ".bin"})
+
+
+def cgroup_cpu_limit() -> int | None:
+    """Read the whole CPUs allowed by this container's cgroup CPU quota, or None if it has none."""
+    # cgroup v2 has "<quota> <period>" in cpu.max ("max" = no quota); v1 has them in two files (-1 = no quota)
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                quota = f.read().strip()
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = f.read().strip()
+        except OSError:
+            return None
+    if quota in ("max", "-1"):
+        return None
+    # A fractional quota (e.g. 0.5 CPU) still gets one worker
+    return max(1, int(quota) // int(period))
+
+
+def default_pool_size() -> int:
+    """Size the worker pool from DICOM_FIXER_POOL_SIZE, or this process's share of the usable cores."""
+    if os.environ.get("DICOM_FIXER_POOL_SIZE"):
+        return max(1, int(os.environ["DICOM_FIXER_POOL_SIZE"]))
+    # Cores this process may be scheduled on (cpu_count() reports every core on the host)
+    if hasattr(os, "sched_getaffinity"):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count() or 1
+    # Affinity ignores CPU quotas, which is how containers get fractional CPUs, so cap by the quota too
+    quota = cgroup_cpu_limit()
+    if quota is not None:
+        cores = min(cores, quota)
+    # Split the cores between the uvicorn workers (WEB_CONCURRENCY) so their pools don't oversubscribe
+    return max(1, cores // max(1, int(os.environ.get("WEB_CONCURRENCY", "1"))))
+
+
+# Worker pool for CPU-bound per-file fixing (created on startup)
+executor: ProcessPoolExecutor | None = None
+POOL_SIZE = default_pool_size()
+# Decompressed ZIP members queued for or being fixed by the pool, per request
+MAX_IN_FLIGHT = 2 * POOL_SIZE
+
+# Upper bound on uploads, in MiB (0 = no limit). Counted over the whole request body,
+# which includes the multipart envelope around the file.
+MAX_UPLOAD_BYTES = int(os.environ.get("DICOM_FIXER_MAX_UPLOAD_MB", "1024")) << 20
+
+# Upper bounds on the uncompressed size of a single DICOM member and of all of them
+# together, in MiB (0 = no limit). A small upload can expand to far more than it
+# declares, so these are checked from the ZIP's central directory before anything is
+# decompressed, and again on the bytes actually read.
+MAX_MEMBER_BYTES = int(os.environ.get("DICOM_FIXER_MAX_MEMBER_MB", "64")) << 20
+MAX_EXTRACTED_BYTES = int(os.environ.get("DICOM_FIXER_MAX_EXTRACTED_MB", "2048")) << 20
+
+
+class UploadSizeLimitMiddleware:
+    """Reject POSTs whose body is larger than `max_bytes`.
+
+    A declared Content-Length is checked before the body is received; chunked bodies
+    (no Content-Length) are counted as they arrive and fail with 413 once over the limit.
+    """
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or not self.max_bytes:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = Headers(scope=scope).get("content-length")
+        response = None
+        if content_length is not None and not content_length.isdigit():
+            response = JSONResponse(status_code=400, content={"detail": "Invalid Content-Length header."})
+        elif content_length is not None and int(content_length) > self.max_bytes:
+            response = JSONResponse(status_code=413, content={"detail": "Uploaded file is too large."})
+        if response is not None:
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # Raised while the form is being parsed, before any response has started
+                    raise HTTPException(status_code=413, detail="Uploaded file is too large.")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+# Added before CORS so that CORS wraps it and rejections still carry CORS headers
+app.add_middleware(UploadSizeLimitMiddleware, max_bytes=MAX_UPLOAD_BYTES)
+
 # --- Enable CORS ---
 app.add_middleware(
     CORSMiddleware,
@@ -25,18 +143,111 @@ app.add_middleware(
 )
 
 
-def fix_single_dicom(ds: FileDataset) -> bytes:
-    """Ensure a DICOM dataset has required metadata and return fixed file bytes."""
-    print(f"[DEBUG] Fixing DICOM {getattr(ds, 'PatientID', 'Unknown ID')} ...")
+def make_executor() -> ProcessPoolExecutor:
+    """Create the worker pool, started from a clean server process rather than forked from uvicorn."""
+    # Forking a process that already runs threadpool threads can deadlock the child,
+    # so use forkserver (with this module preloaded) where available, else spawn
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload([__name__])
+    else:
+        context = multiprocessing.get_context("spawn")
+
+    return ProcessPoolExecutor(max_workers=POOL_SIZE, mp_context=context)
+
+
+def reset_executor(broken: ProcessPoolExecutor):
+    """Replace a pool that broke because a worker died (e.g. OOM-killed)."""
+    global executor
+    if executor is broken:
+        log.error("Worker pool is broken, restarting it")
+        broken.shutdown(wait=False, cancel_futures=True)
+        executor = make_executor()
+
+
+@app.on_event("startup")
+def start_executor():
+    global executor
+    executor = make_executor()
+
+
+@app.on_event("shutdown")
+def stop_executor():
+    if executor is not None:
+        executor.shutdown()
+
+
+def generate_slice_uids(count: int) -> list[str]:
+    """Derive `count` unique, equal-length instance UIDs from a single generated root UID."""
+    # "2.25.<uuid>" roots are at most 44 chars, leaving room for the ".<n>" suffix.
+    # Suffixes are offset by a power of ten so every UID has the same length.
+    root = generate_uid(prefix=None)
+    base = 10 ** len(str(count))
+    uids = [f"{root}.{base + n}" for n in range(1, count + 1)]
+    if uids and len(uids[-1]) > 64:
+        raise ValueError(f"Cannot derive {count} UIDs within the 64 character limit")
+    return uids
+
+
+# Tags fix_single_dicom fills in when missing
+REQUIRED_TAGS = (
+    "SOPClassUID",
+    "SOPInstanceUID",
+    "Modality",
+    "PatientName",
+    "PatientID",
+    "StudyInstanceUID",
+    "SeriesInstanceUID",
+    "ImagePositionPatient",
+    "ImageOrientationPatient",
+    "PixelSpacing",
+    "SliceThickness",
+    "PhotometricInterpretation",
+    "ContentDate",
+    "ContentTime",
+)
+REQUIRED_FILE_META = ("TransferSyntaxUID", "MediaStorageSOPClassUID", "MediaStorageSOPInstanceUID")
+
+
+def is_complete_part10(ds: FileDataset, original: bytes) -> bool:
+    """Check whether the original file is Part-10 and already has every required tag."""
+    if original[128:132] != b"DICM":
+        return False
+    file_meta = getattr(ds, "file_meta", None)
+    if file_meta is None or not all(getattr(file_meta, kw, None) for kw in REQUIRED_FILE_META):
+        return False
+    return all(getattr(ds, kw, None) for kw in REQUIRED_TAGS)
+
+
+def fix_single_dicom(
+    ds: FileDataset,
+    content_date: str,
+    content_time: str,
+    original: bytes | None = None,
+) -> bytes:
+    """Ensure a DICOM dataset has required metadata and return fixed file bytes.
+
+    `content_date`/`content_time` are used when the dataset has none, and are
+    computed once per request so every file in a batch gets the same stamp.
+
+    If `original` (the bytes `ds` was read from) is already a complete Part-10 file,
+    it is returned unchanged instead of re-encoding the dataset.
+    """
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Fixing DICOM %s ...", getattr(ds, "PatientID", "Unknown ID"))
+
+    if original is not None and is_complete_part10(ds, original):
+        log.debug("DICOM already complete, passing through")
+        return original
 
     # Ensure minimal required metadata
     ds.SOPClassUID = getattr(ds, "SOPClassUID", "1.2.840.10008.5.1.4.1.1.2")
-    ds.SOPInstanceUID = getattr(ds, "SOPInstanceUID", generate_uid())
+    ds.SOPInstanceUID = getattr(ds, "SOPInstanceUID", None) or generate_uid()
     ds.Modality = getattr(ds, "Modality", "CT")
     ds.PatientName = getattr(ds, "PatientName", "Anonymous")
     ds.PatientID = getattr(ds, "PatientID", "12345")
-    ds.StudyInstanceUID = getattr(ds, "StudyInstanceUID", generate_uid())
-    ds.SeriesInstanceUID = getattr(ds, "SeriesInstanceUID", generate_uid())
+    ds.StudyInstanceUID = getattr(ds, "StudyInstanceUID", None) or generate_uid()
+    ds.SeriesInstanceUID = getattr(ds, "SeriesInstanceUID", None) or generate_uid()
     ds.ImagePositionPatient = getattr(ds, "ImagePositionPatient", [0.0, 0.0, 0.0])
     ds.ImageOrientationPatient = getattr(
         ds, "ImageOrientationPatient", [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
@@ -46,195 +257,472 @@ def fix_single_dicom(ds: FileDataset) -> bytes:
     ds.PhotometricInterpretation = getattr(ds, "PhotometricInterpretation", "MONOCHROME2")
 
     # Add content date/time if missing
-    dt = datetime.datetime.now()
-    ds.ContentDate = dt.strftime("%Y%m%d")
-    ds.ContentTime = dt.strftime("%H%M%S")
+    ds.ContentDate = getattr(ds, "ContentDate", None) or content_date
+    ds.ContentTime = getattr(ds, "ContentTime", None) or content_time
 
     # Save to bytes
     with io.BytesIO() as buffer:
         ds.save_as(buffer, write_like_original=False)
-        print("[DEBUG] DICOM saved successfully")
+        log.debug("DICOM saved successfully")
         return buffer.getvalue()
 
 
-@app.post("/dicom/fix")
-async def fix_dicom_zip(file: UploadFile):
-    """Accept a ZIP file of DICOM files, fix each one, and return a ZIP of corrected DICOMs."""
-    print(f"[INFO] Received ZIP: {file.filename}")
+def fix_dicom_file(
+    name: str,
+    data: bytes,
+    content_date: str,
+    content_time: str,
+) -> tuple[str, bytes | None, str | None]:
+    """Read and fix a single DICOM file in a worker process.
 
+    Returns (name, fixed_bytes, None) on success or (name, None, error_message) on failure.
+    """
     try:
-        zip_bytes = await file.read()
-        print(f"[DEBUG] ZIP size: {len(zip_bytes)} bytes")
-
-        with tempfile.TemporaryDirectory() as tmpdir:
-            input_zip_path = os.path.join(tmpdir, "input.zip")
-            with open(input_zip_path, "wb") as f:
-                f.write(zip_bytes)
-
-            # Extract uploaded ZIP
-            with zipfile.ZipFile(input_zip_path, "r") as zip_ref:
-                zip_ref.extractall(tmpdir)
-            extracted = os.listdir(tmpdir)
-            print(f"[DEBUG] Extracted files: {extracted}")
-
-            total_files = 0
-            error_files = 0
-
-            # Prepare output ZIP in memory
-            output_zip_bytes = io.BytesIO()
-            with zipfile.ZipFile(output_zip_bytes, "w", zipfile.ZIP_DEFLATED) as output_zip:
-                for name in extracted:
-                    if not name.lower().endswith((".dcm", ".raw", ".bin")):
-                        print(f"[DEBUG] Skipping non-DICOM file: {name}")
-                        continue
+        # Try reading as DICOM
+        ds = pydicom.dcmread(io.BytesIO(data), force=True)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Loaded DICOM: Rows=%s, Cols=%s, Bits=%s", getattr(ds, "Rows", "N/A"),
+                      getattr(ds, "Columns", "N/A"), getattr(ds, "BitsAllocated", "N/A"))
+        return name, fix_single_dicom(ds, content_date, content_time, data), None
 
-                    total_files += 1
-                    input_path = os.path.join(tmpdir, name)
-                    print(f"[INFO] Processing {name} ...")
+    except InvalidDicomError:
+        return name, None, f"{name} is not a valid DICOM file (missing header)"
 
-                    try:
-                        # Try reading as DICOM
-                        ds = pydicom.dcmread(input_path, force=True)
-                        print(f"[DEBUG] Loaded DICOM: Rows={getattr(ds, 'Rows', 'N/A')}, "
-                              f"Cols={getattr(ds, 'Columns', 'N/A')}, Bits={getattr(ds, 'BitsAllocated', 'N/A')}")
+    except Exception as e:
+        msg = f"Error fixing {name}: {str(e)}"
+        if DEBUG_TRACE:
+            msg += f"\n{traceback.format_exc()}"
+        return name, None, msg
+
+
+def make_ct_slice_template(
+    rows: int,
+    cols: int,
+    study_uid: str,
+    series_uid: str,
+    content_date: str,
+    content_time: str,
+) -> FileDataset:
+    """Build a CT slice dataset with every tag that is shared across a converted series."""
+    ds = FileDataset(
+        None,
+        {},
+        file_meta=Dataset(),
+        preamble=b"\0" * 128,
+    )
 
-                        fixed_data = fix_single_dicom(ds)
-                        output_zip.writestr(f"fixed_{name}", fixed_data)
-                        print(f"[INFO] Successfully fixed {name}")
+    # File meta
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta.MediaStorageSOPClassUID = CTImageStorage
+
+    # Core identifiers
+    ds.SOPClassUID = CTImageStorage
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = series_uid
+    ds.Modality = "CT"
+
+    # Patient (dummy / anonymized)
+    ds.PatientName = "Anonymous"
+    ds.PatientID = "NIFTI001"
+
+    # Image geometry
+    ds.Rows = rows
+    ds.Columns = cols
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.PixelSpacing = [1.0, 1.0]
+    ds.SliceThickness = 1.0
+
+    # Pixel format
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.PixelRepresentation = 1
+
+    # Dates
+    ds.ContentDate = content_date
+    ds.ContentTime = content_time
+    return ds
+
+
+def encode_elements(ds: Dataset) -> bytes:
+    """Encode a dataset's elements as Explicit VR Little Endian, without preamble or file meta."""
+    fp = DicomBytesIO()
+    fp.is_little_endian = True
+    fp.is_implicit_VR = False
+    write_dataset(fp, ds)
+    return fp.getvalue()
+
+
+# Explicit VR Little Endian element headers: group, element, VR and value length
+SHORT_ELEMENT_HEADER = struct.Struct("<HH2sH")
+LONG_ELEMENT_HEADER = struct.Struct("<HH2sHI")
+
+
+def encode_text_element(group: int, element: int, vr: bytes, value: str) -> bytes:
+    """Encode a text element (e.g. IS, DS) with a 2-byte length, space-padded to even length."""
+    data = value.encode("ascii")
+    if len(data) % 2:
+        data += b" "
+    return SHORT_ELEMENT_HEADER.pack(group, element, vr, len(data)) + data
+
+
+class CTSliceEncoder:
+    """Encode slices of a series by splicing per-slice elements into a pre-encoded template.
+
+    The template's file meta and static elements are encoded once with pydicom. For each
+    slice only the instance UID, InstanceNumber, ImagePositionPatient and PixelData are
+    packed by hand, in the same Explicit VR Little Endian layout ds.save_as() would write.
+    """
 
-                    except InvalidDicomError:
-                        error_files += 1
-                        msg = f"{name} is not a valid DICOM file (missing header)"
-                        print("[ERROR]", msg)
-                        output_zip.writestr(f"error_{name}.txt", msg)
+    # Per-slice elements, in tag order (PixelData is handled separately, it is always last)
+    SLICE_TAGS = ("SOPInstanceUID", "InstanceNumber", "ImagePositionPatient")
+
+    def __init__(self, template: FileDataset, uid_length: int):
+        # File meta: the instance UID is overwritten in place, so all UIDs must share one length
+        template.file_meta.MediaStorageSOPInstanceUID = "9" * uid_length
+        fp = DicomBytesIO()
+        write_file_meta_info(fp, template.file_meta)
+        meta = fp.getvalue()
+        self.meta_uid_offset = 128 + 4 + meta.index(b"9" * uid_length)
+        self.uid_length = uid_length
+        self.header = bytearray(template.preamble + b"DICM" + meta)
+
+        # SOP Instance UID (0008,0018), null-padded to even length by the "s" format
+        uid_value_length = uid_length + uid_length % 2
+        self.uid_element = struct.Struct(f"<HH2sH{uid_value_length}s")
+        self.uid_value_length = uid_value_length
+
+        # Static elements, split into the runs that lie between the per-slice elements
+        slice_tags = [tag_for_keyword(kw) for kw in self.SLICE_TAGS]
+        runs = [Dataset() for _ in range(len(slice_tags) + 1)]
+        for elem in template:
+            if elem.keyword in self.SLICE_TAGS or elem.keyword == "PixelData":
+                continue
+            runs[sum(elem.tag > tag for tag in slice_tags)].add(elem)
+        self.static_runs = [encode_elements(run) for run in runs]
+
+    def write(self, fp, uid: str, instance_number: int, position: list[float], pixel_data: bytes):
+        """Write one slice to `fp` part by part, without assembling it in an intermediate buffer."""
+        if len(uid) != self.uid_length:
+            raise ValueError(f"UID {uid} does not match the template UID length {self.uid_length}")
+        uid_bytes = uid.encode("ascii")
+        self.header[self.meta_uid_offset:self.meta_uid_offset + self.uid_length] = uid_bytes
+        fp.write(self.header)
+        fp.write(self.static_runs[0])
+        fp.write(self.uid_element.pack(0x0008, 0x0018, b"UI", self.uid_value_length, uid_bytes))
+        fp.write(self.static_runs[1])
+        fp.write(encode_text_element(0x0020, 0x0013, b"IS", str(instance_number)))
+        fp.write(self.static_runs[2])
+        position_value = "\\".join(format_number_as_ds(float(v)) for v in position)
+        fp.write(encode_text_element(0x0020, 0x0032, b"DS", position_value))
+        fp.write(self.static_runs[3])
+
+        # Pixel Data (7FE0,0010), OW with a 4-byte length
+        fp.write(LONG_ELEMENT_HEADER.pack(0x7FE0, 0x0010, b"OW", 0, len(pixel_data)))
+        fp.write(pixel_data)
+
+
+class ZipChunkSink:
+    """Seekable file object that collects ZipFile output so it can be sent in chunks.
+
+    ZipFile seeks back to patch each entry's local header with its CRC and sizes, so
+    entries get real local headers rather than data descriptors (which streaming readers
+    can't handle for STORED entries). drain() must only be called between entries.
+    """
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+        self.offset = 0  # Bytes already drained
+
+    def write(self, data) -> int:
+        return self.buffer.write(data)
+
+    def tell(self) -> int:
+        return self.offset + self.buffer.tell()
+
+    def seek(self, pos: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            if pos < self.offset:
+                raise OSError("Cannot seek into data that has already been sent")
+            self.buffer.seek(pos - self.offset)
+        else:
+            self.buffer.seek(pos, whence)
+        return self.tell()
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = self.buffer.getvalue()
+        self.offset += len(data)
+        self.buffer = io.BytesIO()
+        return data
+
+
+def stream_fixed_zip(
+    zip_ref: zipfile.ZipFile,
+    members: list[tuple[str, zipfile.ZipInfo]],
+    content_date: str,
+    content_time: str,
+):
+    """Fix DICOMs in the worker pool and yield the output ZIP as each file completes.
+
+    Members are decompressed only as the pool has room for them, so at most
+    MAX_IN_FLIGHT of them are held in memory at once. The response status is already
+    sent by the time files are fixed, so every failure is reported as an error_*.txt
+    entry and the archive is always completed.
+    """
+    total_files = len(members)
+    error_files = 0
+    extracted = 0
 
+    pending = collections.deque()
+    sink = ZipChunkSink()
+    fix = functools.partial(fix_dicom_file, content_date=content_date, content_time=content_time)
+    try:
+        with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED) as output_zip:
+            remaining = iter(members)
+            while True:
+                # Top up the pool before waiting on the oldest result
+                for name, info in remaining:
+                    pool = executor
+                    try:
+                        data = read_member(zip_ref, info)
+                        extracted += len(data)
+                        if MAX_EXTRACTED_BYTES and extracted > MAX_EXTRACTED_BYTES:
+                            raise ValueError("ZIP archive expands past the decompressed size limit")
+                        pending.append((name, pool, pool.submit(fix, name, data)))
                     except Exception as e:
+                        # Corrupt member, or a pool that broke since the last result
+                        if isinstance(e, BrokenProcessPool):
+                            reset_executor(pool)
                         error_files += 1
-                        msg = f"Error fixing {name}: {str(e)}\n{traceback.format_exc()}"
-                        print("[ERROR]", msg)
-                        output_zip.writestr(f"error_{name}.txt", msg)
-
-            print(f"[SUMMARY] Processed {total_files} files, {error_files} errors")
-
-            output_zip_bytes.seek(0)
-            return StreamingResponse(
-                output_zip_bytes,
-                media_type="application/zip",
-                headers={
-                    "Content-Disposition": 'attachment; filename="fixed_dicoms.zip"'
-                },
-            )
+                        error = f"Error fixing {name}: {str(e)}"
+                        log.error("%s", error)
+                        output_zip.writestr(f"error_{name}.txt", error)
+                        yield sink.drain()
+                        continue
+                    if len(pending) >= MAX_IN_FLIGHT:
+                        break
+                if not pending:
+                    break
+
+                name, pool, future = pending.popleft()
+                try:
+                    _, fixed_data, error = future.result()
+                except Exception as e:
+                    # The worker itself failed (e.g. it was killed); later files go to a fresh pool
+                    if isinstance(e, BrokenProcessPool):
+                        reset_executor(pool)
+                    fixed_data, error = None, f"Error fixing {name}: {str(e)}"
+
+                if error is not None:
+                    error_files += 1
+                    log.error("%s", error)
+                    output_zip.writestr(f"error_{name}.txt", error)
+                else:
+                    output_zip.writestr(f"fixed_{name}", fixed_data)
+                    log.debug("Successfully fixed %s", name)
+                yield sink.drain()
+
+        # Central directory
+        yield sink.drain()
+        log.info("Processed %d files, %d errors", total_files, error_files)
+
+    finally:
+        # Don't leave work queued if the client went away mid-response
+        for _, _, future in pending:
+            future.cancel()
+
+
+def read_member(zip_ref: zipfile.ZipFile, info: zipfile.ZipInfo) -> bytes:
+    """Decompress one ZIP member, refusing to go past MAX_MEMBER_BYTES whatever its header says."""
+    with zip_ref.open(info) as src:
+        if not MAX_MEMBER_BYTES:
+            return src.read()
+        data = src.read(MAX_MEMBER_BYTES + 1)
+    if len(data) > MAX_MEMBER_BYTES:
+        raise ValueError(f"File is larger than {MAX_MEMBER_BYTES >> 20} MiB when decompressed")
+    return data
+
+
+def is_macos_metadata(path: str) -> bool:
+    """Check for the __MACOSX/ folder and ._* AppleDouble files macOS adds to ZIPs."""
+    return path.startswith("__MACOSX/") or "/__MACOSX/" in path or os.path.basename(path).startswith("._")
+
+
+def unique_output_name(path: str, used: set[str]) -> str:
+    """Flatten a member path into a file name that no other member of the request uses."""
+    stem, ext = os.path.splitext(path.replace("/", "_"))
+    name = stem + ext
+    n = 1
+    # Compared case-insensitively, as the output is often extracted on Windows or macOS
+    while name.lower() in used:
+        name = f"{stem}_{n}{ext}"
+        n += 1
+    used.add(name.lower())
+    return name
+
+
+def list_dicom_members(zip_ref: zipfile.ZipFile) -> list[tuple[str, zipfile.ZipInfo]]:
+    """Pick the DICOM members of an uploaded ZIP from its central directory, with unique output names."""
+    dicom_infos = []
+    for info in zip_ref.infolist():
+        if info.is_dir() or os.path.splitext(info.filename)[1].lower() not in DICOM_EXTENSIONS:
+            log.debug("Skipping non-DICOM file: %s", info.filename)
+            continue
+        if is_macos_metadata(info.filename):
+            log.debug("Skipping macOS metadata file: %s", info.filename)
+            continue
+        dicom_infos.append(info)
+
+    if not dicom_infos:
+        raise HTTPException(status_code=400, detail="ZIP archive contains no .dcm, .raw or .bin files.")
+
+    # Reject ZIP bombs from their declared sizes before anything is decompressed
+    if MAX_MEMBER_BYTES:
+        for info in dicom_infos:
+            if info.file_size > MAX_MEMBER_BYTES:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"{info.filename} is larger than {MAX_MEMBER_BYTES >> 20} MiB when decompressed.",
+                )
+    if MAX_EXTRACTED_BYTES and sum(info.file_size for info in dicom_infos) > MAX_EXTRACTED_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"ZIP archive is larger than {MAX_EXTRACTED_BYTES >> 20} MiB when decompressed.",
+        )
+
+    used = set()
+    return [(unique_output_name(info.filename, used), info) for info in dicom_infos]
+
+
+@app.post("/dicom/fix")
+async def fix_dicom_zip(file: UploadFile):
+    """Accept a ZIP file of DICOM files, fix each one, and return a ZIP of corrected DICOMs."""
+    log.info("Received ZIP: %s", file.filename)
+
+    try:
+        # Starlette has already spooled the upload (to disk past 1 MiB), and the file stays
+        # open until the response has been sent, so members are read from it in place.
+        # Parsing the central directory is blocking work, keep it off the event loop.
+        zip_ref = await run_in_threadpool(zipfile.ZipFile, file.file, "r")
+        members = list_dicom_members(zip_ref)
+
+        # One content date/time stamp for the whole request
+        now = datetime.datetime.now()
+        content_date = now.strftime("%Y%m%d")
+        content_time = now.strftime("%H%M%S")
+
+        return StreamingResponse(
+            stream_fixed_zip(zip_ref, members, content_date, content_time),
+            media_type="application/zip",
+            headers={
+                "Content-Disposition": 'attachment; filename="fixed_dicoms.zip"'
+            },
+        )
 
     except zipfile.BadZipFile:
-        print("[ERROR] Uploaded file is not a valid ZIP archive")
+        log.error("Uploaded file is not a valid ZIP archive")
         raise HTTPException(status_code=400, detail="Uploaded file is not a valid ZIP archive.")
+    except HTTPException:
+        raise
     except Exception as e:
-        print("[FATAL] Unhandled exception in fix_dicom_zip:")
-        print(traceback.format_exc())
+        log.exception("Unhandled exception in fix_dicom_zip")
         return JSONResponse(status_code=500, content={"error": str(e)})
 
 
+def convert_nifti(nifti_path: str, zip_path: str) -> str:
+    """Convert a NIfTI file to a ZIP of DICOM slices written to `zip_path`, and return that path."""
+    # Load NIfTI lazily; slices are read (memory-mapped for .nii) one at a time
+    # instead of materializing the whole volume as float64
+    nii = nib.load(nifti_path, keep_file_open=True)
+    proxy = nii.dataobj
+    affine = nii.affine
+
+    # Volume shape
+    rows, cols, slices = proxy.shape
+    log.debug("Volume shape: %s", proxy.shape)
+
+    # Shared UIDs
+    study_uid = generate_uid()
+    series_uid = generate_uid()
+    instance_uids = generate_slice_uids(slices)
+
+    # Values shared by every slice
+    origin_x = float(affine[0, 3])
+    origin_y = float(affine[1, 3])
+    origin_z = float(affine[2, 3])
+    now = datetime.datetime.now()
+    content_date = now.strftime("%Y%m%d")
+    content_time = now.strftime("%H%M%S")
+
+    # Static tags are encoded once; each slice only encodes its own elements
+    ds = make_ct_slice_template(rows, cols, study_uid, series_uid, content_date, content_time)
+
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_STORED) as zip_out:
+        # An empty volume yields an empty ZIP
+        if not slices:
+            return zip_path
+        encoder = CTSliceEncoder(ds, len(instance_uids[0]))
+
+        for i in range(slices):
+            # Normalize to int16 (DICOM-friendly)
+            slice_data = np.asarray(proxy[:, :, i], dtype=np.int16, order="C")
+
+            # Write slice straight into its ZIP entry
+            with zip_out.open(f"{i:04d}.dcm", "w") as dst:
+                encoder.write(
+                    dst,
+                    instance_uids[i],
+                    i + 1,
+                    [origin_x, origin_y, origin_z + i],
+                    memoryview(slice_data).cast("B"),
+                )
+
+    return zip_path
+
+
 @app.post("/dicom/nifti-convert")
 async def nifti_to_dicom_zip(file: UploadFile):
     """
     Convert a .nii or .nii.gz file to a ZIP of DICOM slices
     """
-    print(f"[INFO] Received NIfTI: {file.filename}")
+    log.info("Received NIfTI: %s", file.filename)
 
     if not file.filename.lower().endswith((".nii", ".nii.gz")):
         raise HTTPException(status_code=400, detail="Only .nii or .nii.gz files are supported")
 
+    # The directory outlives the handler: it holds the output ZIP until it has been sent
+    tmpdir = tempfile.mkdtemp()
     try:
-        with tempfile.TemporaryDirectory() as tmpdir:
-            nifti_path = os.path.join(tmpdir, file.filename)
-            with open(nifti_path, "wb") as f:
-                f.write(await file.read())
-
-            # Load NIfTI
-            nii = nib.load(nifti_path)
-            data = nii.get_fdata()
-            affine = nii.affine
-
-            # Normalize to int16 (DICOM-friendly)
-            data = np.asarray(data, dtype=np.int16)
-
-            # Volume shape
-            rows, cols, slices = data.shape
-            print(f"[DEBUG] Volume shape: {data.shape}")
-
-            # Shared UIDs
-            study_uid = generate_uid()
-            series_uid = generate_uid()
-
-            output_zip = io.BytesIO()
-            with zipfile.ZipFile(output_zip, "w", zipfile.ZIP_DEFLATED) as zip_out:
-                for i in range(slices):
-                    ds = FileDataset(
-                        None,
-                        {},
-                        file_meta=Dataset(),
-                        preamble=b"\0" * 128,
-                    )
-
-                    # File meta
-                    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
-                    ds.file_meta.MediaStorageSOPClassUID = CTImageStorage
-                    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
-
-                    # Core identifiers
-                    ds.SOPClassUID = CTImageStorage
-                    ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
-                    ds.StudyInstanceUID = study_uid
-                    ds.SeriesInstanceUID = series_uid
-                    ds.Modality = "CT"
-
-                    # Patient (dummy / anonymized)
-                    ds.PatientName = "Anonymous"
-                    ds.PatientID = "NIFTI001"
-
-                    # Image geometry
-                    ds.Rows = rows
-                    ds.Columns = cols
-                    ds.InstanceNumber = i + 1
-                    ds.ImagePositionPatient = [
-                        float(affine[0, 3]),
-                        float(affine[1, 3]),
-                        float(affine[2, 3] + i),
-                    ]
-                    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
-                    ds.PixelSpacing = [1.0, 1.0]
-                    ds.SliceThickness = 1.0
-
-                    # Pixel data
-                    slice_data = data[:, :, i]
-                    ds.PixelData = slice_data.tobytes()
-                    ds.BitsAllocated = 16
-                    ds.BitsStored = 16
-                    ds.HighBit = 15
-                    ds.SamplesPerPixel = 1
-                    ds.PhotometricInterpretation = "MONOCHROME2"
-                    ds.PixelRepresentation = 1
-
-                    # Dates
-                    now = datetime.datetime.now()
-                    ds.ContentDate = now.strftime("%Y%m%d")
-                    ds.ContentTime = now.strftime("%H%M%S")
-
-                    # Write slice
-                    with io.BytesIO() as buffer:
-                        ds.save_as(buffer, write_like_original=False)
-                        zip_out.writestr(f"{i:04d}.dcm", buffer.getvalue())
-
-            output_zip.seek(0)
-            return StreamingResponse(
-                output_zip,
-                media_type="application/zip",
-                headers={
-                    "Content-Disposition": 'attachment; filename="dicom_from_nifti.zip"'
-                },
+        nifti_path = os.path.join(tmpdir, file.filename)
+        with open(nifti_path, "wb") as f:
+            while chunk := await file.read(1 << 20):
+                f.write(chunk)
+
+        # Converting is CPU-bound, run it in the worker pool so the event loop stays free.
+        # The worker writes the ZIP to disk, so only its path comes back through the pipe.
+        loop = asyncio.get_running_loop()
+        pool = executor
+        try:
+            zip_path = await loop.run_in_executor(
+                pool, convert_nifti, nifti_path, os.path.join(tmpdir, "dicom_from_nifti.zip")
             )
+        except BrokenProcessPool:
+            reset_executor(pool)
+            raise
+
+        return FileResponse(
+            zip_path,
+            media_type="application/zip",
+            filename="dicom_from_nifti.zip",
+            background=BackgroundTask(shutil.rmtree, tmpdir, ignore_errors=True),
+        )
 
     except Exception as e:
-        print("[ERROR] NIfTI conversion failed")
-        print(traceback.format_exc())
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        log.exception("NIfTI conversion failed")
         raise HTTPException(status_code=500, detail=str(e))
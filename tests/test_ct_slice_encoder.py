@@ -0,0 +1,41 @@
+import io
+
+import numpy as np
+import pydicom
+from pydicom.valuerep import format_number_as_ds
+
+import app
+
+
+def make_template():
+    return app.make_ct_slice_template(5, 7, "1.2.3", "1.2.4", "20260101", "101010")
+
+
+def test_encoder_matches_save_as():
+    slices = 120
+    uids = app.generate_slice_uids(slices)
+    encoder = app.CTSliceEncoder(make_template(), len(uids[0]))
+    volume = (np.random.default_rng(0).random((slices, 5, 7)) * 2000 - 1000).astype(np.int16)
+
+    for i in (0, 1, 57, slices - 1):
+        position = [-12.5, 3.25, 0.1 * i - 77.3333]
+        got = io.BytesIO()
+        encoder.write(got, uids[i], i + 1, position, volume[i].tobytes())
+
+        ref = make_template()
+        ref.file_meta.MediaStorageSOPInstanceUID = uids[i]
+        ref.SOPInstanceUID = uids[i]
+        ref.InstanceNumber = i + 1
+        ref.ImagePositionPatient = [format_number_as_ds(v) for v in position]
+        ref.PixelData = volume[i].tobytes()
+        expected = io.BytesIO()
+        ref.save_as(expected, enforce_file_format=True)
+
+        assert got.getvalue() == expected.getvalue()
+        assert pydicom.dcmread(io.BytesIO(got.getvalue())).SOPInstanceUID == uids[i]
+
+
+def test_slice_uids_have_fixed_length():
+    uids = app.generate_slice_uids(120)
+    assert len({len(uid) for uid in uids}) == 1
+    assert len(set(uids)) == 120
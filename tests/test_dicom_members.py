@@ -0,0 +1,37 @@
+import io
+import zipfile
+
+import pytest
+from fastapi import HTTPException
+
+import app
+
+
+def make_zip(names):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zf:
+        for name in names:
+            zf.writestr(name, b"")
+    return zipfile.ZipFile(buffer)
+
+
+def output_names(names):
+    return [name for name, _ in app.list_dicom_members(make_zip(names))]
+
+
+def test_skips_macos_metadata():
+    names = ["a.dcm", "__MACOSX/._a.dcm", "scans/._b.dcm", "scans/__MACOSX/c.dcm", "scans/b.dcm"]
+    assert output_names(names) == ["a.dcm", "scans_b.dcm"]
+
+
+def test_only_macos_metadata_is_rejected():
+    with pytest.raises(HTTPException) as exc:
+        app.list_dicom_members(make_zip(["__MACOSX/._a.dcm", "._b.dcm"]))
+    assert exc.value.status_code == 400
+
+
+def test_output_names_are_unique():
+    names = ["a/b.dcm", "a_b.dcm", "A_B.dcm", "a/b_1.dcm", "c/b.dcm"]
+    output = output_names(names)
+    assert output == ["a_b.dcm", "a_b_1.dcm", "A_B_2.dcm", "a_b_1_1.dcm", "c_b.dcm"]
+    assert len({name.lower() for name in output}) == len(output)